@@ -5,27 +5,74 @@ A FastAPI service that removes PII/PHI before sending to LLM and reinserts it in
 Created by Mher Aghabalyan
 """
 
+import os
 import uuid
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import asyncio
+from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List, Dict
 from services.pii_service import PIIService
-from services.llm_service import LLMService
+from services.llm_service import LLMService, LLMUnavailableError, PromptTooLargeError, LLM_MAX_INPUT_TOKENS
+from services.batch_analyzer import AnalysisBatcher
 
 app = FastAPI(
     title="HIPAA-Compliant AI Gateway",
     description="Gateway that removes PII/PHI before LLM processing and reinserts it in responses",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializes the (potentially large) prompt/response payloads faster
+    default_response_class=ORJSONResponse
 )
 
 # Initialize services
 pii_service = PIIService()
 llm_service = LLMService()
 
+# Concurrent /chat prompts are coalesced into batched Presidio/spaCy calls
+analysis_batcher = AnalysisBatcher(
+    pii_service,
+    max_batch_size=int(os.getenv("ANALYSIS_BATCH_SIZE", "32")),
+    max_wait_ms=float(os.getenv("ANALYSIS_BATCH_WAIT_MS", "10"))
+)
+
+# Upper bound on in-flight /chat requests per worker; beyond this we shed load
+# with 503 instead of queueing and letting tail latency collapse
+CONCURRENT_REQUESTS_PER_WORKER = int(os.getenv("CONCURRENT_REQUESTS_PER_WORKER", "64"))
+llm_semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS_PER_WORKER)
+
+# Cap on concurrent LLM calls fanned out by /chat-batch, derived from the
+# provider's queries-per-minute quota so a large batch can't blow through it
+LLM_RATE_QPM = int(os.getenv("LLM_RATE_QPM", "600"))
+fanout_semaphore = asyncio.Semaphore(max(1, LLM_RATE_QPM // 60))
+
+# Cheap bound on raw prompt length, enforced at validation so an oversize
+# prompt is rejected before the Presidio/spaCy pass; set well above the usual
+# ~4 characters per token, as the exact token count is still checked afterwards
+PROMPT_MAX_CHARS = int(os.getenv("PROMPT_MAX_CHARS", str(LLM_MAX_INPUT_TOKENS * 8)))
+
+# Most prompts accepted in one /chat-batch request, which holds a single
+# concurrency slot
+CHAT_BATCH_MAX_PROMPTS = int(os.getenv("CHAT_BATCH_MAX_PROMPTS", "32"))
+
+
+def _llm_error_status(error: LLMUnavailableError) -> int:
+    """504 when the provider timed out, 502 for any other upstream failure"""
+    return 504 if error.timed_out else 502
+
+
+async def limit_concurrency():
+    """Acquire an LLM slot for the duration of the request, or reject with 503 if saturated"""
+    if llm_semaphore.locked():
+        raise HTTPException(status_code=503, detail="Server is at capacity, please retry shortly.")
+    async with llm_semaphore:
+        yield
+
 
 class PromptRequest(BaseModel):
-    prompt: str
+    prompt: str = Field(..., max_length=PROMPT_MAX_CHARS)
     session_id: Optional[str] = None
+    # Capped server-side by LLM_MAX_OUTPUT_TOKENS
+    max_output_tokens: Optional[int] = Field(default=None, gt=0)
 
 
 class PromptResponse(BaseModel):
@@ -38,10 +85,32 @@ class PromptResponse(BaseModel):
     session_id: str
 
 
+class PromptBatchRequest(BaseModel):
+    prompts: List[PromptRequest] = Field(..., min_length=1, max_length=CHAT_BATCH_MAX_PROMPTS)
+
+
+class PromptBatchResponse(BaseModel):
+    responses: List[PromptResponse]
+
+
 class DetectPIIRequest(BaseModel):
     text: str
 
 
+@app.on_event("startup")
+async def startup():
+    # Runs in each worker after fork; builds the analyzer here when it was
+    # deferred (GPU mode), so the first request doesn't pay for model loading
+    await asyncio.to_thread(pii_service.load)
+    analysis_batcher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await analysis_batcher.stop()
+    await llm_service.aclose()
+
+
 @app.get("/")
 async def root():
     return {
@@ -63,7 +132,7 @@ async def detect_pii(request: DetectPIIRequest):
     Useful for testing and understanding what Presidio detects.
     """
     try:
-        detected_entities = pii_service.detect_pii(request.text)
+        detected_entities = await asyncio.to_thread(pii_service.detect_pii, request.text)
         return {
             "text": request.text,
             "entities_detected": len(detected_entities),
@@ -73,7 +142,19 @@ async def detect_pii(request: DetectPIIRequest):
         raise HTTPException(status_code=500, detail=f"Error detecting PII: {str(e)}")
 
 
-@app.post("/chat", response_model=PromptResponse)
+@app.post("/cache/clear")
+async def clear_cache():
+    """
+    Operator endpoint to drop cached analyzer results and LLM completions,
+    e.g. after changing recognizers, the spaCy model or the LLM.
+    """
+    return {
+        "analysis_cache_cleared": pii_service.analysis_cache.clear(),
+        "completion_cache_cleared": llm_service.clear_cache()
+    }
+
+
+@app.post("/chat", response_model=PromptResponse, dependencies=[Depends(limit_concurrency)])
 async def chat(request: PromptRequest):
     """
     Process a chat request by:
@@ -87,24 +168,36 @@ async def chat(request: PromptRequest):
     Request body should be JSON with:
     - prompt: str (required)
     - session_id: str (optional)
+    - max_output_tokens: int (optional, capped server-side)
     """
     try:
         # Generate or use provided session_id
         session_id = request.session_id or str(uuid.uuid4())
         
         # Step 1: Detect and remove PII/PHI
-        deidentified_prompt, detected_entities, tokens = pii_service.deidentify(
+        # Analysis runs in the batcher's worker thread alongside other
+        # concurrent prompts, keeping the event loop free
+        analyzer_results = await analysis_batcher.analyze(request.prompt)
+        # Token substitution updates the session store, which may be Redis
+        deidentified_prompt, detected_entities, tokens = await asyncio.to_thread(
+            pii_service.deidentify,
             request.prompt, 
-            session_id
+            session_id,
+            analyzer_results=analyzer_results
         )
         
         # Step 2: Send to LLM
         llm_response = await llm_service.get_completion(
-            deidentified_prompt
+            deidentified_prompt,
+            max_output_tokens=request.max_output_tokens
         )
         
         # Step 3: Reinsert PII/PHI using session_id
-        reidentified_response = pii_service.reidentify(llm_response, session_id)
+        reidentified_response = await asyncio.to_thread(
+            pii_service.reidentify,
+            llm_response,
+            session_id
+        )
         
         return PromptResponse(
             original_prompt=request.prompt,
@@ -116,6 +209,111 @@ async def chat(request: PromptRequest):
             session_id=session_id
         )
     
+    except PromptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except LLMUnavailableError as e:
+        raise HTTPException(status_code=_llm_error_status(e), detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request format: {str(e)}. Make sure to send JSON with Content-Type: application/json header.")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+
+async def _fanout_completion(prompt: str, max_output_tokens: Optional[int]) -> str:
+    """LLM call for one item of a batch, bounded by the fan-out semaphore"""
+    async with fanout_semaphore:
+        # /chat-batch checks every prompt's size before fanning out
+        return await llm_service.get_completion(
+            prompt,
+            max_output_tokens=max_output_tokens,
+            size_checked=True
+        )
+
+
+@app.post("/chat-batch", response_model=PromptBatchResponse, dependencies=[Depends(limit_concurrency)])
+async def chat_batch(request: PromptBatchRequest):
+    """
+    Process several chat prompts in one request.
+    
+    All prompts are analyzed for PII/PHI in a single batched Presidio pass,
+    then sent to the LLM concurrently, and each response is reidentified
+    with its own session's tokens.
+    
+    Request body should be JSON with:
+    - prompts: list of 1 to CHAT_BATCH_MAX_PROMPTS {prompt, session_id} objects, as accepted by /chat
+    """
+    try:
+        items = request.prompts
+        session_ids = [item.session_id or str(uuid.uuid4()) for item in items]
+        prompts = [item.prompt for item in items]
+        
+        # Step 1: Detect and remove PII/PHI for all prompts in one batch
+        def deidentify_all():
+            analyzer_results = pii_service.analyze_batch(prompts)
+            return [
+                pii_service.deidentify(prompt, session_id, analyzer_results=results)
+                for prompt, session_id, results in zip(prompts, session_ids, analyzer_results)
+            ]
+        
+        deidentified = await asyncio.to_thread(deidentify_all)
+        
+        # Reject the whole batch before any LLM call if one prompt is too large,
+        # rather than after the others have already been sent (and paid for)
+        size_checks = await asyncio.gather(
+            *(llm_service.check_prompt_size(deidentified_prompt) for deidentified_prompt, _, _ in deidentified),
+            return_exceptions=True
+        )
+        for index, error in enumerate(size_checks):
+            if isinstance(error, PromptTooLargeError):
+                raise HTTPException(status_code=413, detail=f"Prompt {index}: {str(error)}")
+            if isinstance(error, Exception):
+                raise error
+        
+        # Step 2: Fan out LLM calls concurrently; collect failures instead of
+        # cancelling the calls still in flight
+        llm_responses = await asyncio.gather(
+            *(
+                _fanout_completion(deidentified_prompt, item.max_output_tokens)
+                for (deidentified_prompt, _, _), item in zip(deidentified, items)
+            ),
+            return_exceptions=True
+        )
+        for index, llm_response in enumerate(llm_responses):
+            if isinstance(llm_response, LLMUnavailableError):
+                raise HTTPException(
+                    status_code=_llm_error_status(llm_response),
+                    detail=f"Prompt {index}: {str(llm_response)}"
+                )
+            if isinstance(llm_response, Exception):
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Error processing prompt {index}: {str(llm_response)}"
+                )
+        
+        # Step 3: Reinsert PII/PHI using each item's session_id
+        reidentified = await asyncio.to_thread(
+            lambda: [
+                pii_service.reidentify(llm_response, session_id)
+                for llm_response, session_id in zip(llm_responses, session_ids)
+            ]
+        )
+        
+        responses = []
+        for index, (deidentified_prompt, detected_entities, tokens) in enumerate(deidentified):
+            responses.append(PromptResponse(
+                original_prompt=prompts[index],
+                deidentified_prompt=deidentified_prompt,
+                llm_response=llm_responses[index],
+                reidentified_response=reidentified[index],
+                detected_entities=detected_entities,
+                tokens_used=tokens,
+                session_id=session_ids[index]
+            ))
+        
+        return PromptBatchResponse(responses=responses)
+    
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid request format: {str(e)}. Make sure to send JSON with Content-Type: application/json header.")
     except Exception as e:
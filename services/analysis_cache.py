@@ -0,0 +1,56 @@
+"""
+Thread-safe LRU cache for Presidio analyzer results
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+from presidio_analyzer import RecognizerResult
+
+
+class AnalysisCache:
+    """
+    LRU cache of analyzer results keyed by a blake2b digest of the text.
+    
+    Only the digest and the results (entity types, offsets, scores) are kept,
+    never the analyzed text itself.
+    """
+    
+    def __init__(self, maxsize: int = 1024):
+        self._store: OrderedDict[bytes, List[RecognizerResult]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+    
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Digest used as the cache key for a text"""
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+    
+    def get(self, text: str) -> Optional[List[RecognizerResult]]:
+        """Get cached results for a text, marking them as recently used"""
+        key = self.key(text)
+        with self._lock:
+            results = self._store.get(key)
+            if results is None:
+                return None
+            self._store.move_to_end(key)
+            return list(results)
+    
+    def set(self, text: str, results: List[RecognizerResult]):
+        """Cache results for a text, evicting the least recently used entry if full"""
+        if self.maxsize <= 0:
+            return
+        key = self.key(text)
+        with self._lock:
+            self._store[key] = list(results)
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+    
+    def clear(self) -> int:
+        """Remove all cached results, returning how many were dropped"""
+        with self._lock:
+            count = len(self._store)
+            self._store.clear()
+            return count
@@ -0,0 +1,96 @@
+"""
+Analysis Batcher
+Coalesces concurrent PII analysis requests into batched Presidio calls
+"""
+
+import asyncio
+from typing import List, Optional, Tuple
+from presidio_analyzer import RecognizerResult
+
+
+class AnalysisBatcher:
+    """
+    Collects texts submitted by concurrent requests and analyzes them together.
+    
+    A background task waits for the first pending text, then keeps collecting
+    for up to max_wait_ms or until max_batch_size texts are queued, and runs
+    the whole batch through PIIService.analyze_batch in a worker thread.
+    spaCy's nlp.pipe amortizes pipeline overhead across the batch.
+    """
+    
+    def __init__(self, pii_service, max_batch_size: int = 32, max_wait_ms: float = 10.0):
+        self.pii_service = pii_service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start the background flush task if it isn't running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background flush task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def analyze(self, text: str) -> List[RecognizerResult]:
+        """
+        Queue a text for batched analysis and wait for its results.
+        
+        Args:
+            text: Input text to scan
+            
+        Returns:
+            Presidio results for this text
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _collect(self) -> List[Tuple[str, asyncio.Future]]:
+        """Wait for one item, then gather more until the batch is full or the window closes"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Drop requests whose callers have already gone away
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            
+            try:
+                results = await asyncio.to_thread(
+                    self.pii_service.analyze_batch,
+                    [text for text, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), text_results in zip(batch, results):
+                if not future.done():
+                    future.set_result(text_results)
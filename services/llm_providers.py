@@ -0,0 +1,172 @@
+"""
+LLM Providers
+REST clients for the supported LLM APIs, sharing one httpx connection pool
+"""
+
+import os
+import math
+from functools import lru_cache
+from typing import Optional, Protocol
+import httpx
+import tiktoken
+
+# Rough characters-per-token ratio used when no local tokenizer is available
+CHARS_PER_TOKEN = 4
+
+# Gemini 2.5 "thinking" tokens count against maxOutputTokens, so a small
+# per-request limit can be used up before any text is produced. 0 disables
+# thinking (2.5 Flash); 2.5 Pro can't disable it and needs at least 128,
+# and -1 lets the model decide
+GEMINI_THINKING_BUDGET = int(os.getenv("GEMINI_THINKING_BUDGET", "0"))
+
+
+def _estimate_tokens(prompt: str) -> int:
+    return math.ceil(len(prompt) / CHARS_PER_TOKEN)
+
+
+@lru_cache(maxsize=16)
+def _openai_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    tiktoken encoding for a model, cached; None if it can't be loaded.
+    
+    The first load of an encoding may download it (unless the files are
+    already in TIKTOKEN_CACHE_DIR), so this must not be called on the event loop.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Unknown model name (e.g. an OpenAI-compatible server): use the newest encoding
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+    except Exception:
+        # Encoding files are fetched on first use and may be unreachable
+        return None
+
+
+class ProviderError(Exception):
+    """Raised when a provider returns an error status or an unusable response"""
+    
+    def __init__(self, message: str, status_code: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+    
+    @property
+    def transient(self) -> bool:
+        """Rate limiting and server errors are worth retrying"""
+        return self.status_code == 429 or self.status_code >= 500
+
+
+def _check_status(response: httpx.Response, provider: str):
+    if response.status_code >= 400:
+        raise ProviderError(
+            f"{provider} API returned {response.status_code}: {response.text[:200]}",
+            status_code=response.status_code
+        )
+
+
+class Provider(Protocol):
+    """Strategy interface implemented by each LLM provider"""
+    
+    default_model: str
+    
+    def load_tokenizer(self, model: str) -> None:
+        ...
+    
+    def count_tokens(self, prompt: str, model: str) -> int:
+        ...
+    
+    async def complete(self, prompt: str, model: str, max_output_tokens: int) -> str:
+        ...
+
+
+class GeminiProvider:
+    """Google Gemini via the generateContent REST endpoint"""
+    
+    default_model = "gemini-2.5-flash"  # Alternative: gemini-2.5-pro for better quality
+    base_url = "https://generativelanguage.googleapis.com/v1beta"
+    
+    def __init__(self, client: httpx.AsyncClient, api_key: str):
+        self.client = client
+        self.api_key = api_key
+    
+    def load_tokenizer(self, model: str) -> None:
+        """Nothing to load - token counts are estimated"""
+        pass
+    
+    def count_tokens(self, prompt: str, model: str) -> int:
+        # Gemini's countTokens is a network call, which would cost the round
+        # trip this check is meant to save; estimate locally instead
+        return _estimate_tokens(prompt)
+    
+    async def complete(self, prompt: str, model: str, max_output_tokens: int) -> str:
+        response = await self.client.post(
+            f"{self.base_url}/models/{model}:generateContent",
+            # Header rather than ?key= so the key stays out of URLs and logs
+            headers={"x-goog-api-key": self.api_key},
+            json={
+                "contents": [{"parts": [{"text": prompt}]}],
+                "generationConfig": {
+                    "temperature": 0.7,
+                    "maxOutputTokens": max_output_tokens,
+                    "thinkingConfig": {"thinkingBudget": GEMINI_THINKING_BUDGET},
+                },
+            }
+        )
+        _check_status(response, "Gemini")
+        
+        candidates = response.json().get("candidates") or []
+        candidate = candidates[0] if candidates else {}
+        parts = candidate.get("content", {}).get("parts", [])
+        text = "".join(part.get("text", "") for part in parts)
+        if not text:
+            if candidate.get("finishReason") == "MAX_TOKENS":
+                raise ProviderError(
+                    f"Gemini API used the whole output budget of {max_output_tokens} tokens "
+                    f"without producing text; raise max_output_tokens or lower GEMINI_THINKING_BUDGET"
+                )
+            raise ProviderError(
+                f"Empty response from Gemini API (finishReason: {candidate.get('finishReason')})"
+            )
+        return text
+
+
+class OpenAIProvider:
+    """OpenAI-compatible chat completions endpoint"""
+    
+    default_model = "gpt-4o-mini"
+    
+    def __init__(self, client: httpx.AsyncClient, api_key: str, base_url: str = "https://api.openai.com/v1"):
+        self.client = client
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+    
+    def load_tokenizer(self, model: str) -> None:
+        """Load (and cache) the tiktoken encoding for a model ahead of the first request"""
+        _openai_encoding(model)
+    
+    def count_tokens(self, prompt: str, model: str) -> int:
+        encoding = _openai_encoding(model)
+        if encoding is None:
+            return _estimate_tokens(prompt)
+        return len(encoding.encode(prompt, disallowed_special=()))
+    
+    async def complete(self, prompt: str, model: str, max_output_tokens: int) -> str:
+        response = await self.client.post(
+            f"{self.base_url}/chat/completions",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json={
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.7,
+                "max_tokens": max_output_tokens,
+            }
+        )
+        _check_status(response, "OpenAI")
+        
+        choices = response.json().get("choices") or []
+        text = choices[0].get("message", {}).get("content") if choices else None
+        if not text:
+            raise ProviderError("Empty response from OpenAI API")
+        return text
@@ -1,78 +1,227 @@
 """
 LLM Service
-Handles communication with Google Gemini API using official library
+Handles communication with the configured LLM provider (Google Gemini or OpenAI)
 """
 
 import os
+import time
 import asyncio
+import hashlib
+import threading
 from typing import Optional
-import google.generativeai as genai
+import httpx
+from cachetools import TTLCache
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from services.llm_providers import Provider, ProviderError, GeminiProvider, OpenAIProvider
+
+# Per-attempt timeouts in seconds; completions are not streamed, so the read
+# timeout must cover generating a full LLM_MAX_OUTPUT_TOKENS response
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+
+# Prompts above LLM_MAX_INPUT_TOKENS are rejected before calling the provider;
+# per-request max_output_tokens is clamped to LLM_MAX_OUTPUT_TOKENS
+LLM_MAX_INPUT_TOKENS = int(os.getenv("LLM_MAX_INPUT_TOKENS", "32000"))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "2048"))
+
+# Completions cached per (model, de-identified prompt); 0 disables the cache
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+
+
+class PromptTooLargeError(ValueError):
+    """Raised when a prompt exceeds LLM_MAX_INPUT_TOKENS"""
+    
+    def __init__(self, token_count: int, limit: int):
+        super().__init__(f"Prompt is {token_count} tokens, above the limit of {limit}")
+        self.token_count = token_count
+        self.limit = limit
+
+
+class LLMUnavailableError(Exception):
+    """Raised when the provider call fails or times out after all retries"""
+    
+    def __init__(self, message: str, timed_out: bool = False):
+        super().__init__(message)
+        self.timed_out = timed_out
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Timeouts, connection failures, rate limiting and 5xx are transient"""
+    if isinstance(error, (httpx.TimeoutException, httpx.ConnectError)):
+        return True
+    return isinstance(error, ProviderError) and error.transient
 
 
 class LLMService:
     """
-    Service for interacting with Google Gemini API.
-    Uses the official google-generativeai library.
+    Service for interacting with an LLM provider over its REST API.
+    
+    A single httpx.AsyncClient is shared by all requests so connections are
+    kept alive and reused; the provider strategy (Gemini or OpenAI) is picked
+    from LLM_PROVIDER, or from whichever API key is set.
     """
     
     def __init__(self):
-        self.api_key = os.getenv("GEMINI_API_KEY", "")
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+        )
+        self.provider: Optional[Provider] = self._create_provider()
+        
+        # For demo purposes, use a mock response if no API key is set
+        self.use_mock = self.provider is None
+        self.model_name = os.getenv("LLM_MODEL") or (
+            self.provider.default_model if self.provider else "mock"
+        )
         
-        if not self.api_key:
-            # For demo purposes, use a mock response if no API key is set
-            self.use_mock = True
-            self.model = None
-        else:
-            self.use_mock = False
-            # Configure the Gemini API
-            genai.configure(api_key=self.api_key)
-            # Use gemini-2.5-flash (free tier, fast, current model)
-            # Alternative: gemini-2.5-pro for better quality
-            self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # Load the tokenizer at startup rather than on the first request,
+        # where a download would stall the event loop
+        if self.provider:
+            self.provider.load_tokenizer(self.model_name)
+        
+        # Prompts reaching the LLM are de-identified, so a cached response can
+        # be reused by any session: each session reidentifies it with its own
+        # tokens. Unlike the analysis cache this holds text, including any PHI
+        # the analyzer missed, for up to LLM_CACHE_TTL_SECONDS
+        self.completion_cache: TTLCache = TTLCache(
+            maxsize=max(LLM_CACHE_SIZE, 1),
+            ttl=LLM_CACHE_TTL_SECONDS,
+            timer=time.monotonic
+        )
+        self._cache_lock = threading.Lock()
+    
+    def _create_provider(self) -> Optional[Provider]:
+        """Pick the provider strategy from the environment, or None for mock mode"""
+        gemini_key = os.getenv("GEMINI_API_KEY", "")
+        openai_key = os.getenv("OPENAI_API_KEY", "")
+        provider = os.getenv("LLM_PROVIDER", "").lower() or ("gemini" if gemini_key or not openai_key else "openai")
+        
+        if provider == "gemini":
+            return GeminiProvider(self.client, gemini_key) if gemini_key else None
+        if provider == "openai":
+            if not openai_key:
+                return None
+            return OpenAIProvider(
+                self.client,
+                openai_key,
+                base_url=os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+            )
+        raise ValueError(f"Unknown LLM_PROVIDER: {provider}")
+    
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        await self.client.aclose()
     
     async def get_completion(
-        self, 
-        prompt: str, 
-        model: Optional[str] = None
+        self,
+        prompt: str,
+        model: Optional[str] = None,
+        max_output_tokens: Optional[int] = None,
+        size_checked: bool = False
     ) -> str:
         """
-        Get completion from Google Gemini.
+        Get completion from the configured provider.
         
         Args:
             prompt: The sanitized prompt (without PII/PHI)
-            model: Model name (ignored - using gemini-2.5-flash)
-            
+            model: Model name (defaults to LLM_MODEL or the provider's default)
+            max_output_tokens: Requested response length, capped at LLM_MAX_OUTPUT_TOKENS
+            size_checked: Skip the token count when the caller already ran check_prompt_size
+        
         Returns:
             LLM response text
+            
+        Raises:
+            PromptTooLargeError: If the prompt exceeds LLM_MAX_INPUT_TOKENS
+            LLMUnavailableError: If the provider fails or times out after all retries
         """
         if self.use_mock:
             # Mock response for demo purposes
             return self._get_mock_response(prompt)
         
+        model = model or self.model_name
+        max_output_tokens = min(max_output_tokens or LLM_MAX_OUTPUT_TOKENS, LLM_MAX_OUTPUT_TOKENS)
+        
+        # Reject oversize prompts up front instead of spending a round trip
+        if not size_checked:
+            await self.check_prompt_size(prompt, model)
+        
+        cache_key = self._cache_key(prompt, model, max_output_tokens)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
-            # Run the synchronous Gemini API call in an executor to avoid blocking
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.model.generate_content(
-                    prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=0.7,
-                        max_output_tokens=2048,  # Increased from 1000 to allow longer responses
-                    )
-                )
-            )
+            # Retry timeouts and transient errors with jittered exponential backoff
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+                wait=wait_random_exponential(max=4),
+                retry=retry_if_exception(_is_retryable),
+                reraise=True
+            ):
+                with attempt:
+                    text = await self.provider.complete(prompt, model, max_output_tokens)
             
-            # Extract text from response
-            if response.text:
-                return response.text
-            else:
-                raise ValueError("Empty response from Gemini API")
+            # Only real completions are cached, never the mock fallback
+            self._cache_set(cache_key, text)
+            return text
         
-        except Exception as e:
-            # Fallback to mock if API call fails
-            print(f"LLM API error: {e}. Using mock response.")
-            return self._get_mock_response(prompt)
+        # Surface failures rather than returning mock text the caller can't
+        # tell apart from a real completion
+        except httpx.TimeoutException as e:
+            raise LLMUnavailableError(
+                f"LLM request timed out after {LLM_MAX_ATTEMPTS} attempts",
+                timed_out=True
+            ) from e
+        except (httpx.HTTPError, ProviderError) as e:
+            raise LLMUnavailableError(f"LLM request failed: {e}") from e
+    
+    async def check_prompt_size(self, prompt: str, model: Optional[str] = None):
+        """
+        Raise PromptTooLargeError if the prompt exceeds LLM_MAX_INPUT_TOKENS.
+        Tokenizing a long prompt is CPU-bound, so it runs in a worker thread.
+        """
+        if self.use_mock:
+            return
+        token_count = await asyncio.to_thread(
+            self.provider.count_tokens,
+            prompt,
+            model or self.model_name
+        )
+        if token_count > LLM_MAX_INPUT_TOKENS:
+            raise PromptTooLargeError(token_count, LLM_MAX_INPUT_TOKENS)
+    
+    def _cache_key(self, prompt: str, model: str, max_output_tokens: int) -> Optional[bytes]:
+        """Digest of (model, output limit, prompt), or None when caching is disabled"""
+        if LLM_CACHE_SIZE <= 0:
+            return None
+        return hashlib.blake2b(f"{model}|{max_output_tokens}|{prompt}".encode(), digest_size=16).digest()
+    
+    def _cache_get(self, key: Optional[bytes]) -> Optional[str]:
+        if key is None:
+            return None
+        with self._cache_lock:
+            return self.completion_cache.get(key)
+    
+    def _cache_set(self, key: Optional[bytes], response: str):
+        if key is None:
+            return
+        with self._cache_lock:
+            self.completion_cache[key] = response
+    
+    def clear_cache(self) -> int:
+        """Remove all cached completions, returning how many were dropped"""
+        with self._cache_lock:
+            count = len(self.completion_cache)
+            self.completion_cache.clear()
+            return count
     
     def _get_mock_response(self, prompt: str) -> str:
         """
@@ -0,0 +1,105 @@
+"""
+Fused Medical Pattern Recognizer
+Detects SSN, MRN and AGE entities with a single precompiled regex scan
+"""
+
+import re
+from typing import Dict, List, Optional, Tuple
+from presidio_analyzer import EntityRecognizer, RecognizerResult, AnalysisExplanation
+from presidio_analyzer.nlp_engine import NlpArtifacts
+
+
+# (group name, entity type, score, regex)
+# Each pattern is tried at every position, so overlapping matches from
+# different patterns are all reported (overlaps are merged in deidentify).
+# Alternation order matters only when two patterns match at the same
+# position: the first listed alternative wins.
+MEDICAL_PATTERNS: List[Tuple[str, str, float, str]] = [
+    # Enhanced SSN patterns - Presidio's default might miss some formats
+    ("ssn_pattern_1", "US_SSN", 0.9,
+     r"\b(?:SSN|Social Security Number|social security)[\s:]*\d{3}-\d{2}-\d{4}\b"),
+    ("ssn_pattern_2", "US_SSN", 0.85, r"\b\d{3}-\d{2}-\d{4}\b"),  # Format: 123-45-6789
+    ("ssn_pattern_3", "US_SSN", 0.85, r"\b\d{3}\s\d{2}\s\d{4}\b"),  # Format: 123 45 6789
+    ("ssn_pattern_4", "US_SSN", 0.7, r"\b\d{9}\b"),  # Format: 123456789 (9 consecutive digits)
+    
+    # Medical Record Number (MRN) patterns
+    ("mrn_pattern_1", "MEDICAL_RECORD_NUMBER", 0.85,
+     r"\b(?:MRN|Medical Record Number|Patient ID|Record #)[\s:#]*[A-Z0-9-]{5,15}\b"),
+    ("mrn_pattern_2", "MEDICAL_RECORD_NUMBER", 0.6, r"\b[A-Z]{2,3}-\d{5,10}\b"),  # Format: ABC-123456
+    
+    # Age patterns
+    ("age_pattern_1", "AGE", 0.7, r"\b(?:age|aged|Age|years old|year old|y\.?o\.?)[\s:]*\d{2,3}\b"),
+    ("age_pattern_2", "AGE", 0.7, r"\b\d{2,3}-year-old\b"),
+    ("age_pattern_3", "AGE", 0.7, r"\(age[:\s]+\d{2,3}\)"),
+]
+
+# Same flags Presidio's PatternRecognizer applies by default
+REGEX_FLAGS = re.DOTALL | re.MULTILINE | re.IGNORECASE
+
+
+class MedicalPatternRecognizer(EntityRecognizer):
+    """
+    Recognizer for custom medical entities (US_SSN, MEDICAL_RECORD_NUMBER, AGE).
+    
+    Instead of registering one PatternRecognizer per entity (each compiling and
+    scanning its own pattern list), all patterns are fused into one regex with
+    named groups so the text is traversed once per analyze call.
+    
+    Each group sits inside a zero-width lookahead, so a match doesn't consume
+    text and a later-starting pattern overlapping it (e.g. the SSN in
+    "aged 123-45-6789") is still found, as with separate recognizers.
+    """
+    
+    def __init__(self, patterns: List[Tuple[str, str, float, str]] = MEDICAL_PATTERNS):
+        self._patterns: Dict[str, Tuple[str, float]] = {
+            name: (entity_type, score) for name, entity_type, score, _ in patterns
+        }
+        self._regex = re.compile(
+            "|".join(f"(?=(?P<{name}>{regex}))" for name, _, _, regex in patterns),
+            REGEX_FLAGS
+        )
+        supported_entities = list(dict.fromkeys(entity for _, entity, _, _ in patterns))
+        super().__init__(
+            supported_entities=supported_entities,
+            name="MedicalPatternRecognizer"
+        )
+    
+    def load(self) -> None:
+        """Nothing to load - the regex is compiled in __init__"""
+        pass
+    
+    def analyze(
+        self,
+        text: str,
+        entities: List[str],
+        nlp_artifacts: Optional[NlpArtifacts] = None
+    ) -> List[RecognizerResult]:
+        """Scan the text once and map each match's group back to its entity"""
+        results = []
+        for match in self._regex.finditer(text):
+            name = match.lastgroup
+            entity_type, score = self._patterns[name]
+            if entities and entity_type not in entities:
+                continue
+            
+            start, end = match.span(name)
+            if start == end:
+                continue
+            
+            explanation = AnalysisExplanation(
+                recognizer=self.name,
+                original_score=score,
+                pattern_name=name,
+                pattern=self._regex.pattern
+            )
+            results.append(
+                RecognizerResult(
+                    entity_type=entity_type,
+                    start=start,
+                    end=end,
+                    score=score,
+                    analysis_explanation=explanation,
+                    recognition_metadata={RecognizerResult.RECOGNIZER_NAME_KEY: self.name}
+                )
+            )
+        return results
@@ -3,121 +3,162 @@ PII/PHI Detection and Removal Service using Presidio
 Detects and removes Protected Health Information (PHI) and Personally Identifiable Information (PII)
 """
 
-import uuid
+import os
 import re
+import itertools
+import threading
 from typing import Dict, List, Optional
-from presidio_analyzer import AnalyzerEngine, PatternRecognizer, Pattern
+from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine, RecognizerResult
 from presidio_analyzer.nlp_engine import NlpEngineProvider
-from services.session_store import SessionStore
+from services.session_store import create_session_store
+from services.reinsertion_service import replace_tokens
+from services.medical_recognizer import MedicalPatternRecognizer
+from services.analysis_cache import AnalysisCache
 
 # Global session store instance
-session_store = SessionStore(expiration_hours=24)
+session_store = create_session_store(expiration_hours=24)
+
+# spaCy model and pipeline components that Presidio doesn't need for NER
+SPACY_MODEL = os.getenv("PRESIDIO_SPACY_MODEL", "en_core_web_sm")
+UNUSED_SPACY_PIPES = ["tagger", "parser", "lemmatizer", "attribute_ruler"]
+USE_GPU = os.getenv("PRESIDIO_USE_GPU") == "1"
+
+# Number of distinct texts whose analyzer results are kept in memory
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+
+# Opt-in prefilter (PII_PREFILTER=1): texts matching neither pattern skip
+# Presidio/spaCy entirely. Any digit covers SSNs, phones, dates, ages, IDs and
+# card numbers; the rest are email/URL/keyword cues. Names and places are only
+# caught by capitalization, so lowercase names ("john smith") would reach the
+# LLM unredacted - which is why full analysis stays the default.
+PII_PREFILTER = os.getenv("PII_PREFILTER", "0") == "1"
+PII_PREFILTER_PATTERN = re.compile(
+    r"\d|@|\w\.[a-z]{2,}\b|\b(?:MRN|SSN|phone|patient id|record #|social security)\b",
+    re.IGNORECASE
+)
+NAME_PREFILTER_PATTERN = re.compile(
+    r"\b(?!(?:What|How|Why|When|Where|Which|Who|Whom|Whose|Is|Are|Was|Were|Do|Does|Did|"
+    r"Can|Could|Should|Would|Please|The|A|An|This|That|These|Those|My|Our|Your|It|If|"
+    r"Explain|Describe|List|Give|Tell|Write|Summarize|Help|In|For|What's|How's)\b)[A-Z][A-Za-z'-]+"
+)
+
+# First 2-3 digit number in a detected AGE span
+AGE_DIGITS_PATTERN = re.compile(r'\d{2,3}')
+
+# Entity types detected and de-identified by the gateway
+PHI_ENTITIES = [
+    "PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME",
+    "LOCATION", "US_SSN", "US_DRIVER_LICENSE",
+    "MEDICAL_RECORD_NUMBER", "AGE", "CREDIT_CARD",
+    "US_PASSPORT", "IP_ADDRESS", "IBAN_CODE", "URL"
+]
+
+
+def _build_analyzer() -> AnalyzerEngine:
+    """Load the spaCy pipeline and build the Presidio analyzer with custom recognizers"""
+    
+    # Optionally run the spaCy pipeline on GPU (requires cupy + matching CUDA).
+    # Must happen before the model is loaded; falls back to CPU silently.
+    if USE_GPU:
+        try:
+            import spacy
+            spacy.require_gpu()
+        except Exception:
+            pass
+    
+    # Configure Presidio to use the small spaCy model (~12 MB)
+    # The entities we need come from NER; en_core_web_md's word vectors add
+    # latency and RAM per worker for little recall gain on these entities.
+    # Override with PRESIDIO_SPACY_MODEL=en_core_web_md if recall drops.
+    nlp_configuration = {
+        "nlp_engine_name": "spacy",
+        "models": [{"lang_code": "en", "model_name": SPACY_MODEL}]
+    }
+    
+    nlp_engine_provider = NlpEngineProvider(nlp_configuration=nlp_configuration)
+    nlp_engine = nlp_engine_provider.create_engine()
+    
+    # Only tok2vec + ner are needed for Presidio's entities; skip the rest
+    for nlp in nlp_engine.nlp.values():
+        nlp.select_pipes(disable=[pipe for pipe in UNUSED_SPACY_PIPES if pipe in nlp.pipe_names])
+    
+    # Initialize analyzer with the configured NLP engine
+    analyzer = AnalyzerEngine(nlp_engine=nlp_engine)
+    
+    # Add custom recognizers for medical entities.
+    # SSN, MRN and AGE patterns are fused into a single recognizer so the
+    # text is scanned once instead of once per pattern.
+    # Note: Adding SSN patterns supplements Presidio's default SSN recognizer
+    analyzer.registry.add_recognizer(MedicalPatternRecognizer())
+    
+    return analyzer
+
+
+# Built once at import so every PIIService shares it, and so that with
+# `gunicorn --preload` forked workers inherit the loaded spaCy model
+# copy-on-write instead of each loading their own.
+# A CUDA context does not survive fork, so with PRESIDIO_USE_GPU=1 the
+# analyzer is instead built lazily, in each worker process.
+_ANALYZER: Optional[AnalyzerEngine] = None if USE_GPU else _build_analyzer()
+_ANALYZER_LOCK = threading.Lock()
+
+
+def get_analyzer() -> AnalyzerEngine:
+    """Return the shared analyzer, building it in this process if needed"""
+    global _ANALYZER
+    if _ANALYZER is None:
+        with _ANALYZER_LOCK:
+            if _ANALYZER is None:
+                _ANALYZER = _build_analyzer()
+    return _ANALYZER
 
 
 class PIIService:
     """Uses Presidio for PHI detection and de-identification"""
     
     def __init__(self):
-        # Configure Presidio to use the medium spaCy model we installed
-        # Using en_core_web_md for better accuracy with word vectors (~91 MB)
-        # Create NLP engine provider with explicit model configuration
-        nlp_configuration = {
-            "nlp_engine_name": "spacy",
-            "models": [{"lang_code": "en", "model_name": "en_core_web_md"}]
-        }
-        
-        nlp_engine_provider = NlpEngineProvider(nlp_configuration=nlp_configuration)
-        nlp_engine = nlp_engine_provider.create_engine()
-        
-        # Initialize analyzer with the configured NLP engine
-        self.analyzer = AnalyzerEngine(nlp_engine=nlp_engine)
-        self._add_custom_recognizers()
-    
-    def _add_custom_recognizers(self):
-        """Add custom recognizers for medical entities"""
-        
-        # Enhanced SSN recognizer - Presidio's default might miss some patterns
-        ssn_patterns = [
-            Pattern(
-                name="ssn_pattern_1",
-                regex=r"\b(?:SSN|Social Security Number|social security)[\s:]*(\d{3}-\d{2}-\d{4})\b",
-                score=0.9
-            ),
-            Pattern(
-                name="ssn_pattern_2",
-                regex=r"\b\d{3}-\d{2}-\d{4}\b",  # Format: 123-45-6789
-                score=0.85
-            ),
-            Pattern(
-                name="ssn_pattern_3",
-                regex=r"\b\d{3}\s\d{2}\s\d{4}\b",  # Format: 123 45 6789
-                score=0.85
-            ),
-            Pattern(
-                name="ssn_pattern_4",
-                regex=r"\b\d{9}\b",  # Format: 123456789 (9 consecutive digits)
-                score=0.7
-            ),
-        ]
-        ssn_recognizer = PatternRecognizer(
-            supported_entity="US_SSN",
-            patterns=ssn_patterns
-        )
-        
-        # Medical Record Number (MRN) recognizer - improved patterns
-        mrn_patterns = [
-            Pattern(
-                name="mrn_pattern_1",
-                regex=r"\b(?:MRN|Medical Record Number|Patient ID|Record #)[\s:#]*([A-Z0-9-]{5,15})\b",
-                score=0.85
-            ),
-            Pattern(
-                name="mrn_pattern_2",
-                regex=r"\b[A-Z]{2,3}-\d{5,10}\b",  # Format: ABC-123456
-                score=0.6
-            ),
-        ]
-        mrn_recognizer = PatternRecognizer(
-            supported_entity="MEDICAL_RECORD_NUMBER",
-            patterns=mrn_patterns
-        )
-        
-        # Enhanced Age recognizer with multiple patterns
-        age_patterns = [
-            Pattern(
-                name="age_pattern_1",
-                regex=r"\b(?:age|aged|Age|years old|year old|y\.?o\.?)[\s:]*(\d{2,3})\b",
-                score=0.7
-            ),
-            Pattern(
-                name="age_pattern_2",
-                regex=r"\b(\d{2,3})-year-old\b",
-                score=0.7
-            ),
-            Pattern(
-                name="age_pattern_3",
-                regex=r"\(age[:\s]+(\d{2,3})\)",
-                score=0.7
-            ),
-        ]
-        age_recognizer = PatternRecognizer(
-            supported_entity="AGE",
-            patterns=age_patterns
-        )
+        self._batch_analyzer: Optional[BatchAnalyzerEngine] = None
         
-        # Add custom recognizers to analyzer
-        # Note: Adding SSN recognizer will override Presidio's default if it exists
-        self.analyzer.registry.add_recognizer(ssn_recognizer)
-        self.analyzer.registry.add_recognizer(mrn_recognizer)
-        self.analyzer.registry.add_recognizer(age_recognizer)
+        # Token ids: a process-wide counter plus a random per-process salt.
+        # Unique without hashing a fresh UUID for every entity.
+        self._reset_token_ids()
+        # Preloaded workers are forked after this runs; give each its own salt
+        os.register_at_fork(after_in_child=self._reset_token_ids)
+        
+        # Identical texts (retries, boilerplate) skip the spaCy pipeline
+        self.analysis_cache = AnalysisCache(maxsize=ANALYSIS_CACHE_SIZE)
+    
+    @property
+    def analyzer(self) -> AnalyzerEngine:
+        return get_analyzer()
+    
+    @property
+    def batch_analyzer(self) -> BatchAnalyzerEngine:
+        # Batch engine shares the analyzer (and its recognizers) but runs spaCy
+        # over many texts at once via nlp.pipe
+        if self._batch_analyzer is None:
+            self._batch_analyzer = BatchAnalyzerEngine(analyzer_engine=self.analyzer)
+        return self._batch_analyzer
+    
+    def load(self):
+        """Make sure the analyzer is built in this process (e.g. at worker startup)"""
+        get_analyzer()
+    
+    def _reset_token_ids(self):
+        self._token_counter = itertools.count()
+        self._token_salt = os.urandom(4).hex()
+    
+    def _make_token(self, entity_type: str) -> str:
+        """Generate a unique placeholder token, e.g. [PERSON_1a3f09c2e]"""
+        return f"[{entity_type}_{next(self._token_counter):x}{self._token_salt}]"
     
     def _extract_age_from_text(self, text: str) -> Optional[int]:
         """Extract numeric age from detected age text"""
-        # Extract all numbers from the text
-        numbers = re.findall(r'\d{2,3}', text)
-        if numbers:
+        # Only the first number is used, so stop scanning at the first match
+        match = AGE_DIGITS_PATTERN.search(text)
+        if match:
             try:
-                age = int(numbers[0])
+                age = int(match.group(0))
                 # Sanity check: age should be 0-120
                 if 0 <= age <= 120:
                     return age
@@ -125,20 +166,82 @@ class PIIService:
                 pass
         return None
     
-    def deidentify(self, text: str, session_id: str) -> tuple[str, List[Dict], Dict[str, str]]:
-        """Analyze and de-identify PHI using Presidio"""
+    def _may_contain_pii(self, text: str) -> bool:
+        """Cheap regex prefilter; False means no PII cue, so analysis can be skipped"""
+        if not PII_PREFILTER:
+            return True
+        return bool(PII_PREFILTER_PATTERN.search(text) or NAME_PREFILTER_PATTERN.search(text))
+    
+    def analyze(self, text: str) -> List[RecognizerResult]:
+        """
+        Analyze a single text, reusing cached results for identical input.
+        Texts without any PII cue skip analysis entirely.
+        
+        Args:
+            text: Input text to scan
+            
+        Returns:
+            Presidio results for the text
+        """
+        if not self._may_contain_pii(text):
+            return []
+        
+        results = self.analysis_cache.get(text)
+        if results is None:
+            results = self.analyzer.analyze(
+                text=text,
+                language='en',
+                entities=PHI_ENTITIES
+            )
+            self.analysis_cache.set(text, results)
+        return results
+    
+    def analyze_batch(self, texts: List[str]) -> List[List[RecognizerResult]]:
+        """
+        Analyze several texts in one spaCy pass.
+        Texts with cached results or without any PII cue are skipped;
+        only the rest are analyzed.
+        
+        Args:
+            texts: Input texts to scan
+            
+        Returns:
+            Presidio results for each text, in input order
+        """
+        results = [
+            self.analysis_cache.get(text) if self._may_contain_pii(text) else []
+            for text in texts
+        ]
+        misses = [i for i, cached in enumerate(results) if cached is None]
+        
+        if misses:
+            analyzed = self.batch_analyzer.analyze_iterator(
+                texts=[texts[i] for i in misses],
+                language='en',
+                entities=PHI_ENTITIES
+            )
+            for i, text_results in zip(misses, analyzed):
+                self.analysis_cache.set(texts[i], text_results)
+                results[i] = text_results
+        
+        return results
+    
+    def deidentify(
+        self,
+        text: str,
+        session_id: str,
+        analyzer_results: Optional[List[RecognizerResult]] = None
+    ) -> tuple[str, List[Dict], Dict[str, str]]:
+        """
+        Analyze and de-identify PHI using Presidio.
+        
+        If analyzer_results are given (e.g. from analyze_batch), the analysis
+        step is skipped and those results are used instead.
+        """
         
         # Analyze text for PII/PHI
-        analyzer_results = self.analyzer.analyze(
-            text=text,
-            language='en',
-            entities=[
-                "PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME",
-                "LOCATION", "US_SSN", "US_DRIVER_LICENSE",
-                "MEDICAL_RECORD_NUMBER", "AGE", "CREDIT_CARD",
-                "US_PASSPORT", "IP_ADDRESS", "IBAN_CODE", "URL"
-            ]
-        )
+        if analyzer_results is None:
+            analyzer_results = self.analyze(text)
         
         # Filter results - ONLY filter ages that are 89 or under
         # Ages over 89 must ALWAYS be de-identified per HIPAA
@@ -161,59 +264,59 @@ class PIIService:
                 # All other entity types: always de-identify
                 filtered_results.append(result)
         
-        # Create tokens for replacement - use UUIDs for uniqueness
-        tokens = {}
-        
-        # Sort by position (reverse) for proper replacement
-        sorted_results = sorted(filtered_results, key=lambda x: x.start, reverse=True)
+        # Sort by position (widest first at equal starts) and merge overlapping
+        # detections into one span, so no part of either reaches the LLM.
+        # Each span is [entity_type, start, end, score]; the type is that of
+        # the span's first detection.
+        spans = []
+        for result in sorted(filtered_results, key=lambda x: (x.start, -x.end)):
+            if spans and result.start < spans[-1][2]:
+                spans[-1][2] = max(spans[-1][2], result.end)
+                spans[-1][3] = max(spans[-1][3], result.score)
+                continue
+            spans.append([result.entity_type, result.start, result.end, result.score])
         
-        deidentified_text = text
-        for result in sorted_results:
-            entity_type = result.entity_type
-            original_value = text[result.start:result.end]
-            
-            # Generate unique token using UUID
-            token = f"[{entity_type}_{uuid.uuid4().hex[:8]}]"
-            tokens[token] = original_value
+        # Create tokens for replacement and rebuild the text in a single forward pass
+        tokens = {}
+        parts = []
+        last_end = 0
+        for entity_type, start, end, _ in spans:
+            token = self._make_token(entity_type)
+            tokens[token] = text[start:end]
             
-            # Replace in text
-            deidentified_text = (
-                deidentified_text[:result.start] +
-                token +
-                deidentified_text[result.end:]
-            )
+            parts.append(text[last_end:start])
+            parts.append(token)
+            last_end = end
+        
+        parts.append(text[last_end:])
+        deidentified_text = "".join(parts)
         
-        # Store/update tokens for this session
-        existing_tokens = session_store.get(session_id)
-        if existing_tokens:
-            tokens.update(existing_tokens)  # Merge with existing
-        session_store.set(session_id, tokens)
+        # Store/update tokens for this session - merged atomically so that
+        # concurrent requests on the same session can't drop each other's tokens
+        tokens = session_store.update(session_id, tokens)
         
-        # Format detected entities for response
+        # Format detected entities for response - the spans actually replaced
         detected_entities = [
             {
-                "entity_type": result.entity_type,
-                "start": result.start,
-                "end": result.end,
-                "score": result.score,
-                "text": text[result.start:result.end]
+                "entity_type": entity_type,
+                "start": start,
+                "end": end,
+                "score": score,
+                "text": text[start:end]
             }
-            for result in filtered_results
+            for entity_type, start, end, score in spans
         ]
         
         return deidentified_text, detected_entities, tokens
     
     def reidentify(self, text: str, session_id: str) -> str:
         """Replace tokens back with original PHI"""
-        tokens = session_store.get(session_id)
+        tokens, automaton = session_store.get_with_automaton(session_id)
         if not tokens:
             return text
         
-        reidentified = text
-        for token, original_value in tokens.items():
-            reidentified = reidentified.replace(token, original_value)
-        
-        return reidentified
+        # Single pass using the session's cached Aho-Corasick automaton
+        return replace_tokens(text, tokens, automaton)
     
     def detect_pii(self, text: str) -> list:
         """
@@ -226,16 +329,7 @@ class PIIService:
         Returns:
             List of detected entities with their positions and types
         """
-        results = self.analyzer.analyze(
-            text=text,
-            language='en',
-            entities=[
-                "PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME",
-                "LOCATION", "US_SSN", "US_DRIVER_LICENSE",
-                "MEDICAL_RECORD_NUMBER", "AGE", "CREDIT_CARD",
-                "US_PASSPORT", "IP_ADDRESS", "IBAN_CODE", "URL"
-            ]
-        )
+        results = self.analyze(text)
         
         return [
             {
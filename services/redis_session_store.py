@@ -0,0 +1,131 @@
+"""
+Redis-backed session storage for PHI tokens shared across workers and replicas
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import ahocorasick
+import redis
+from cachetools import TTLCache
+from services.reinsertion_service import build_token_automaton
+
+# Hash field holding a random write version; tokens are always bracketed,
+# so this name can never collide with one
+VERSION_FIELD = "_version"
+
+
+class RedisSessionStore:
+    """
+    Session storage in Redis with an in-process L1 cache.
+    
+    Each session is a hash at session:{session_id} mapping tokens to original
+    values, plus a version field rewritten on every change. The L1 cache keeps
+    tokens and their automaton per worker; a read only fetches the version
+    (and refreshes the TTL) and re-downloads the tokens when another worker
+    has changed them.
+    """
+    
+    def __init__(
+        self,
+        redis_url: str = "redis://localhost:6379/0",
+        expiration_hours: int = 24,
+        max_sessions: int = 100_000
+    ):
+        self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.expiration_hours = expiration_hours
+        self._ttl_ms = int(expiration_hours * 3600 * 1000)
+        self._l1: TTLCache = TTLCache(
+            maxsize=max_sessions,
+            ttl=expiration_hours * 3600,
+            timer=time.monotonic
+        )
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"session:{session_id}"
+    
+    def _load(self, session_id: str) -> Optional[Dict]:
+        """Return the L1 entry for a session, refreshing it from Redis if stale"""
+        key = self._key(session_id)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hget(key, VERSION_FIELD)
+        pipe.pexpire(key, self._ttl_ms)
+        version, _ = pipe.execute()
+        
+        with self._lock:
+            if version is None:
+                self._l1.pop(session_id, None)
+                return None
+            session = self._l1.get(session_id)
+            if session is not None and session['version'] == version:
+                return session
+        
+        tokens = self._redis.hgetall(key)
+        version = tokens.pop(VERSION_FIELD, None)
+        if version is None:
+            return None
+        return self._cache(session_id, version, tokens)
+    
+    def _cache(self, session_id: str, version: str, tokens: Dict[str, str]) -> Dict:
+        """Store a fresh L1 entry for a session"""
+        session = {'version': version, 'tokens': tokens, 'automaton': None}
+        with self._lock:
+            self._l1[session_id] = session
+        return session
+    
+    def get(self, session_id: str) -> Optional[Dict[str, str]]:
+        """Get tokens for a session if it exists and hasn't expired"""
+        session = self._load(session_id)
+        return session['tokens'] if session else None
+    
+    def get_with_automaton(
+        self,
+        session_id: str
+    ) -> Tuple[Optional[Dict[str, str]], Optional[ahocorasick.Automaton]]:
+        """
+        Get tokens for a session together with their token-matching automaton.
+        The automaton is built lazily and cached in L1 until the tokens change.
+        """
+        session = self._load(session_id)
+        if not session:
+            return None, None
+        with self._lock:
+            if session['automaton'] is None:
+                session['automaton'] = build_token_automaton(session['tokens'])
+            return session['tokens'], session['automaton']
+    
+    def set(self, session_id: str, tokens: Dict[str, str]):
+        """Set tokens for a session with expiration, replacing any existing ones"""
+        key = self._key(session_id)
+        version = os.urandom(8).hex()
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping={**tokens, VERSION_FIELD: version})
+        pipe.pexpire(key, self._ttl_ms)
+        pipe.execute()
+        self._cache(session_id, version, dict(tokens))
+    
+    def update(self, session_id: str, new_tokens: Dict[str, str]) -> Dict[str, str]:
+        """
+        Update tokens for a session, merging with existing tokens.
+        Returns a snapshot of the merged tokens.
+        """
+        key = self._key(session_id)
+        version = os.urandom(8).hex()
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(key, mapping={**new_tokens, VERSION_FIELD: version})
+        pipe.pexpire(key, self._ttl_ms)
+        pipe.hgetall(key)
+        _, _, tokens = pipe.execute()
+        tokens.pop(VERSION_FIELD, None)
+        self._cache(session_id, version, tokens)
+        return dict(tokens)
+    
+    def delete(self, session_id: str) -> bool:
+        """Delete a session"""
+        with self._lock:
+            self._l1.pop(session_id, None)
+        return self._redis.delete(self._key(session_id)) > 0
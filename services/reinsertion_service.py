@@ -4,18 +4,145 @@ Reinserts PII/PHI data back into LLM responses
 """
 
 import re
-from typing import Dict
+import threading
+from typing import Dict, List, Optional, Tuple
+import ahocorasick
+
+try:
+    import hyperscan
+except ImportError:
+    # Hyperscan wheels are x86-only; fall back to Python's re elsewhere
+    hyperscan = None
+
+# Gateway placeholders: [ENTITY_TYPE_hexid], e.g. [US_SSN_1a3f09c2e]
+PLACEHOLDER_REGEX = r'\[[A-Z_]+_[0-9a-f]+\]'
+
+
+def build_token_automaton(tokens: Dict[str, str]) -> Optional[ahocorasick.Automaton]:
+    """
+    Build an Aho-Corasick automaton over every token in the map.
+    
+    Each token maps to (token length, original value) so matches can be
+    substituted without a dict lookup. Returns None when there are no tokens.
+    """
+    if not tokens:
+        return None
+    automaton = ahocorasick.Automaton()
+    for token, original_value in tokens.items():
+        automaton.add_word(token, (len(token), original_value))
+    automaton.make_automaton()
+    return automaton
+
+
+def replace_tokens(
+    text: str,
+    tokens: Dict[str, str],
+    automaton: Optional[ahocorasick.Automaton] = None
+) -> str:
+    """
+    Replace every token occurrence in a single pass over the text.
+    
+    Args:
+        text: Text containing tokens
+        tokens: Dictionary mapping tokens to original values
+        automaton: Prebuilt automaton from build_token_automaton (built if omitted)
+        
+    Returns:
+        Text with tokens replaced by their original values
+    """
+    if automaton is None:
+        automaton = build_token_automaton(tokens)
+    if automaton is None:
+        return text
+    
+    # iter_long yields non-overlapping, longest matches left to right
+    parts = []
+    last_end = 0
+    for end_index, (length, original_value) in automaton.iter_long(text):
+        start = end_index - length + 1
+        parts.append(text[last_end:start])
+        parts.append(original_value)
+        last_end = end_index + 1
+    
+    if not parts:
+        return text
+    parts.append(text[last_end:])
+    return "".join(parts)
 
 
 class ReinsertionService:
     """
     Service for reinserting PII/PHI into LLM responses.
     Replaces placeholders with original values.
+    
+    Placeholders are located with a single Hyperscan scan when the library is
+    available, otherwise with the equivalent compiled regex.
     """
     
     def __init__(self):
-        # Pattern to match Presidio-style placeholders: [ENTITY_TYPE_NUMBER]
-        self.placeholder_pattern = re.compile(r'\[([A-Z_]+)_(\d+)\]')
+        # Pattern to match gateway placeholders: [ENTITY_TYPE_HEXID]
+        self.placeholder_pattern = re.compile(PLACEHOLDER_REGEX)
+        self._database = None
+        # Hyperscan scratch space is per-scan state; one per thread lets
+        # concurrent scans of the shared database run without locking
+        self._local = threading.local()
+        
+        if hyperscan is not None:
+            # SOM_LEFTMOST makes Hyperscan report start offsets, not just ends
+            self._database = hyperscan.Database()
+            self._database.compile(
+                expressions=[PLACEHOLDER_REGEX.encode()],
+                ids=[0],
+                elements=1,
+                flags=[hyperscan.HS_FLAG_SOM_LEFTMOST]
+            )
+    
+    def _scratch(self):
+        """Return this thread's scratch space, allocating it on first use"""
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = hyperscan.Scratch(self._database)
+            self._local.scratch = scratch
+        return scratch
+    
+    def find_placeholders(self, text: str) -> List[Tuple[str, int, int]]:
+        """
+        Locate placeholders in the text.
+        
+        Args:
+            text: LLM response text
+            
+        Returns:
+            Non-overlapping (placeholder, start, end) tuples in text order
+        """
+        if self._database is None:
+            return [(m.group(0), m.start(), m.end()) for m in self.placeholder_pattern.finditer(text)]
+        
+        data = text.encode()
+        spans = []
+        
+        def on_match(pattern_id, start, end, flags, context):
+            spans.append((start, end))
+        
+        self._database.scan(data, match_event_handler=on_match, scratch=self._scratch())
+        
+        # Placeholders are ASCII, so decoding a matched span is always valid;
+        # byte offsets are converted back to character offsets
+        placeholders = []
+        last_end = 0
+        char_offset = 0
+        byte_offset = 0
+        for start, end in sorted(spans):
+            if start < last_end:
+                continue
+            char_offset += len(data[byte_offset:start].decode())
+            byte_offset = start
+            placeholder = data[start:end].decode()
+            placeholders.append((placeholder, char_offset, char_offset + len(placeholder)))
+            char_offset += len(placeholder)
+            byte_offset = end
+            last_end = end
+        return placeholders
     
     def reinsert_pii(self, text: str, pii_map: Dict[str, str]) -> str:
         """
@@ -28,14 +155,22 @@ class ReinsertionService:
         Returns:
             Text with PII/PHI reinserted
         """
-        result = text
-        
-        # Replace all placeholders with their original values
-        # Sort by placeholder length (longest first) to avoid partial replacements
-        sorted_placeholders = sorted(pii_map.keys(), key=len, reverse=True)
+        if not pii_map:
+            return text
         
-        for placeholder in sorted_placeholders:
-            if placeholder in result:
-                result = result.replace(placeholder, pii_map[placeholder])
+        # Single scan for placeholders, then one forward rebuild; placeholders
+        # not in the map are left as they are
+        parts = []
+        last_end = 0
+        for placeholder, start, end in self.find_placeholders(text):
+            original_value = pii_map.get(placeholder)
+            if original_value is None:
+                continue
+            parts.append(text[last_end:start])
+            parts.append(original_value)
+            last_end = end
         
-        return result
+        if not parts:
+            return text
+        parts.append(text[last_end:])
+        return "".join(parts)
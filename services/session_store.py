@@ -2,64 +2,103 @@
 Thread-safe session storage with expiration for PHI token management
 """
 
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+import os
 import threading
+import time
+import ahocorasick
+from cachetools import TTLCache
+from services.reinsertion_service import build_token_automaton
 
 
 class SessionStore:
     """Thread-safe session storage with expiration for managing PHI tokens"""
     
-    def __init__(self, expiration_hours: int = 24):
-        self._store: Dict[str, Dict] = {}
+    def __init__(self, expiration_hours: int = 24, max_sessions: int = 100_000):
+        # TTLCache expires entries lazily on access and evicts the least
+        # recently used session once max_sessions is reached
+        self._store: TTLCache = TTLCache(
+            maxsize=max_sessions,
+            ttl=expiration_hours * 3600,
+            timer=time.monotonic
+        )
+        # TTLCache is not thread-safe (reads can expire entries), so every access is locked
         self._lock = threading.Lock()
         self.expiration_hours = expiration_hours
     
     def get(self, session_id: str) -> Optional[Dict[str, str]]:
         """Get tokens for a session if it exists and hasn't expired"""
         with self._lock:
-            if session_id in self._store:
-                session = self._store[session_id]
-                # Check expiration
-                if datetime.now() < session['expires_at']:
-                    return session['tokens']
-                else:
-                    # Expired, clean up
-                    del self._store[session_id]
-            return None
+            session = self._store.get(session_id)
+            return session['tokens'] if session else None
+    
+    def get_with_automaton(
+        self,
+        session_id: str
+    ) -> Tuple[Optional[Dict[str, str]], Optional[ahocorasick.Automaton]]:
+        """
+        Get tokens for a session together with their token-matching automaton.
+        The automaton is built lazily on first use and cached until the tokens change.
+        """
+        with self._lock:
+            session = self._store.get(session_id)
+            if not session:
+                return None, None
+            if session['automaton'] is None:
+                session['automaton'] = build_token_automaton(session['tokens'])
+            return session['tokens'], session['automaton']
     
     def set(self, session_id: str, tokens: Dict[str, str]):
         """Set tokens for a session with expiration"""
         with self._lock:
-            self._store[session_id] = {
-                'tokens': tokens,
-                'expires_at': datetime.now() + timedelta(hours=self.expiration_hours)
-            }
+            self._set(session_id, tokens)
     
-    def update(self, session_id: str, new_tokens: Dict[str, str]):
-        """Update tokens for a session, merging with existing tokens"""
+    def _set(self, session_id: str, tokens: Dict[str, str]):
+        """Store tokens and reset the cached automaton. Caller holds the lock."""
+        # Assigning (re)starts the entry's TTL
+        self._store[session_id] = {
+            'tokens': tokens,
+            'automaton': None
+        }
+    
+    def update(self, session_id: str, new_tokens: Dict[str, str]) -> Dict[str, str]:
+        """
+        Update tokens for a session, merging with existing tokens.
+        Returns a snapshot of the merged tokens, taken under the same lock.
+        """
         with self._lock:
-            if session_id not in self._store:
-                self.set(session_id, new_tokens)
+            session = self._store.get(session_id)
+            if session is None:
+                self._set(session_id, dict(new_tokens))
             else:
-                self._store[session_id]['tokens'].update(new_tokens)
-                # Refresh expiration
-                self._store[session_id]['expires_at'] = datetime.now() + timedelta(hours=self.expiration_hours)
+                session['tokens'].update(new_tokens)
+                # Tokens changed, invalidate the cached automaton
+                session['automaton'] = None
+                # Re-assign to refresh expiration
+                self._store[session_id] = session
+            return dict(self._store[session_id]['tokens'])
     
     def delete(self, session_id: str) -> bool:
         """Delete a session"""
         with self._lock:
-            if session_id in self._store:
-                del self._store[session_id]
-                return True
-            return False
-    
-    def cleanup_expired(self):
-        """Remove expired sessions"""
-        with self._lock:
-            now = datetime.now()
-            expired = [sid for sid, data in self._store.items() if now >= data['expires_at']]
-            for sid in expired:
-                del self._store[sid]
-            return len(expired)
+            return self._store.pop(session_id, None) is not None
+
 
+def create_session_store(expiration_hours: int = 24):
+    """
+    Create the session store selected by SESSION_BACKEND.
+    
+    - memory (default): in-process store, sessions are local to one worker
+    - redis: shared store at REDIS_URL, required when running multiple
+      workers or replicas so any of them can reidentify a session
+    """
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    if backend == "redis":
+        from services.redis_session_store import RedisSessionStore
+        return RedisSessionStore(
+            redis_url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            expiration_hours=expiration_hours
+        )
+    if backend != "memory":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    return SessionStore(expiration_hours=expiration_hours)